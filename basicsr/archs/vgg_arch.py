@@ -122,6 +122,10 @@ class VGGFeatureExtractor(nn.Module):
                 modified_net[k] = v
 
         self.vgg_net = nn.Sequential(modified_net)
+        # a feature only needs to be copied if the next layer (an in-place relu)
+        # would overwrite it
+        layers = list(modified_net.items())
+        self.clone_names = {k for (k, _), (_, v) in zip(layers, layers[1:]) if getattr(v, 'inplace', False)}
 
         if not requires_grad:
             self.vgg_net.eval()
@@ -137,6 +141,15 @@ class VGGFeatureExtractor(nn.Module):
             self.register_buffer('mean', torch.Tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
             # the std is for image with range [0, 1]
             self.register_buffer('std', torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+            # normalize with a single multiply-add: x * scale + shift
+            scale = 1 / self.std
+            shift = -self.mean * scale
+            if self.range_norm:
+                # fold (x + 1) / 2 in as well
+                shift = shift + scale / 2
+                scale = scale / 2
+            self.register_buffer('scale', scale, persistent=False)
+            self.register_buffer('shift', shift, persistent=False)
 
     def forward(self, x):
         """Forward function.
@@ -147,15 +160,16 @@ class VGGFeatureExtractor(nn.Module):
         Returns:
             Tensor: Forward results.
         """
-        if self.range_norm:
-            x = (x + 1) / 2
         if self.use_input_norm:
-            x = (x - self.mean) / self.std
+            # range_norm is folded into scale and shift
+            x = torch.addcmul(self.shift, x, self.scale)
+        elif self.range_norm:
+            x = (x + 1) / 2
 
         output = {}
         for key, layer in self.vgg_net._modules.items():
             x = layer(x)
             if key in self.layer_name_list:
-                output[key] = x.clone()
+                output[key] = x.clone() if key in self.clone_names else x
 
         return output
@@ -1,33 +1,205 @@
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
-import itertools
+import weakref
 from torchvision.models.vgg import vgg16
 from torchvision.models import alexnet
 from collections import OrderedDict
 
 from basicsr.archs.vgg_arch import VGGFeatureExtractor
 from basicsr.utils.registry import LOSS_REGISTRY
-from .loss_util import weighted_loss
+from .loss_util import compile_loss, weight_reduce_loss, weighted_loss
 
 _reduction_modes = ['none', 'mean', 'sum']
+_amp_dtypes = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+# dtypes accepted by autocast on each device (cpu autocast only supports bf16 on torch 2.0)
+_autocast_dtypes = {'cuda': (torch.float16, torch.bfloat16), 'cpu': (torch.bfloat16, )}
 
 
+@compile_loss
 @weighted_loss
 def l1_loss(pred, target):
     return F.l1_loss(pred, target, reduction='none')
 
 
+@compile_loss
 @weighted_loss
 def mse_loss(pred, target):
     return F.mse_loss(pred, target, reduction='none')
 
 
+@compile_loss
 @weighted_loss
 def charbonnier_loss(pred, target, eps=1e-12):
     return torch.sqrt((pred - target)**2 + eps)
 
 
+@compile_loss
+def weighted_tv_loss(pred, weight=None, reduction='mean'):
+    """Total variation loss, with both directions computed in one pass.
+
+    Args:
+        pred (Tensor): of shape (N, C, H, W). Predicted tensor.
+        weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
+        reduction (str): Options are 'mean' and 'sum'. Default: 'mean'.
+
+    Returns:
+        Tensor: Sum of the vertical and horizontal L1 losses.
+    """
+    y_diff = (pred[:, :, :-1, :] - pred[:, :, 1:, :]).abs()
+    x_diff = (pred[:, :, :, :-1] - pred[:, :, :, 1:]).abs()
+    if weight is None:
+        y_weight = None
+        x_weight = None
+    else:
+        y_weight = weight[:, :, :-1, :]
+        x_weight = weight[:, :, :, :-1]
+
+    return weight_reduce_loss(y_diff, y_weight, reduction) + weight_reduce_loss(x_diff, x_weight, reduction)
+
+
+@compile_loss
+def fro_loss(pred, target):
+    """Frobenius norm of the difference, fused into one pass when compiled.
+
+    Args:
+        pred (Tensor): Predicted tensor.
+        target (Tensor): Ground truth tensor, with the same shape as pred.
+
+    Returns:
+        Tensor: Scalar Frobenius norm of (pred - target).
+    """
+    return torch.linalg.vector_norm(pred - target)
+
+
+@compile_loss
+def feature_loss(pred, target, criterion='l1'):
+    """Distance between two feature maps, as used by PerceptualLoss.
+
+    Args:
+        pred (Tensor): Predicted features.
+        target (Tensor): Ground truth features, with the same shape as pred.
+        criterion (str): 'l1' | 'l2' (mean absolute / squared error) | 'fro'
+            (Frobenius norm of the difference). Default: 'l1'.
+
+    Returns:
+        Tensor: Scalar loss.
+    """
+    if criterion == 'l1':
+        return F.l1_loss(pred, target)
+    elif criterion == 'l2':
+        return F.mse_loss(pred, target)
+    return fro_loss(pred, target)
+
+
+@compile_loss
+def spatial_mse(pred, target):
+    """Per-channel spatial mean of the squared difference.
+
+    When compiled, the difference is reduced on the fly instead of
+    materializing the full (n, c, h, w) squared difference.
+
+    Args:
+        pred (Tensor): of shape (n, c, h, w). Predicted tensor.
+        target (Tensor): of shape (n, c, h, w). Ground truth tensor.
+
+    Returns:
+        Tensor: of shape (n, c).
+    """
+    return (pred - target).square().mean((2, 3))
+
+
+@compile_loss
+def lpips_distance(feats_x, feats_y, lin_weight):
+    """LPIPS distance summed over the batch, from normalized features.
+
+    The 1x1 linear layers commute with the spatial mean, so the squared
+    diffs are reduced to (n, c) first and all the layers are applied as a
+    single matmul. When compiled, the whole tail is fused as well.
+
+    Args:
+        feats_x (list[Tensor]): Normalized features of x, each with shape (n, c_i, h_i, w_i).
+        feats_y (list[Tensor]): Normalized features of y, with the same shapes.
+        lin_weight (Tensor): Weights of all the linear layers, flattened and
+            concatenated, with shape (sum(c_i), ).
+
+    Returns:
+        Tensor: Scalar LPIPS distance.
+    """
+    diff = [spatial_mse(fx, fy) for fx, fy in zip(feats_x, feats_y)]
+    return torch.sum(torch.cat(diff, 1) @ lin_weight)
+
+
+@compile_loss
+def normalize_activation(x, eps=1e-10):
+    """Normalize features to unit length along the channel dim.
+
+    Uses rsqrt with eps folded in as eps**2, so that the division becomes a
+    multiply. When compiled, the channel reduction and the scaling are fused.
+    The computation is done in fp32 and cast back to the input dtype, since
+    under fp16 autocast both the squares and eps**2 would overflow/underflow.
+
+    Args:
+        x (Tensor): Features with shape (n, c, h, w).
+        eps (float): A value to avoid division by zero. Default: 1e-10.
+
+    Returns:
+        Tensor: Normalized features with shape (n, c, h, w).
+    """
+    x_float = x.float()
+    return (x_float * torch.rsqrt(x_float.square().sum(dim=1, keepdim=True) + eps * eps)).to(x.dtype)
+
+
+def get_amp_dtype(amp_dtype):
+    """Get the autocast dtype for a frozen feature network.
+
+    Args:
+        amp_dtype (str | None): 'fp16' | 'bf16', or None to run in fp32.
+
+    Returns:
+        torch.dtype | None: The autocast dtype.
+    """
+    if amp_dtype is None:
+        return None
+    if amp_dtype not in _amp_dtypes:
+        raise ValueError(f'Unsupported amp dtype: {amp_dtype}. Supported ones are: {list(_amp_dtypes.keys())}')
+    return _amp_dtypes[amp_dtype]
+
+
+def extract_features(net, x, channels_last=False, amp_dtype=None):
+    """Run a frozen feature network, optionally in channels_last and autocast.
+
+    Features are cast back to fp32, so that the criterion on top of them is
+    computed in full precision.
+
+    Args:
+        net (nn.Module): Feature network, returning a dict or a list of Tensors.
+        x (Tensor): Input tensor with shape (n, c, h, w).
+        channels_last (bool): Whether to feed x in channels_last memory format.
+            Default: False.
+        amp_dtype (torch.dtype | None): Autocast dtype. It must be supported by
+            autocast on the device of x: fp16 or bf16 on cuda, bf16 on cpu.
+            Default: None.
+
+    Returns:
+        dict[str, Tensor] | list[Tensor]: Features returned by net.
+    """
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    if amp_dtype is None:
+        return net(x)
+
+    # the frozen weights are stored in amp_dtype, so autocast must not silently
+    # fall back to fp32 for this device
+    if amp_dtype not in _autocast_dtypes.get(x.device.type, ()):
+        raise ValueError(f'Autocast with {amp_dtype} is not supported on {x.device.type}.')
+    with torch.autocast(x.device.type, dtype=amp_dtype):
+        features = net(x)
+    if isinstance(features, dict):
+        return {k: v.float() for k, v in features.items()}
+    return [v.float() for v in features]
+
+
 @LOSS_REGISTRY.register()
 class L1Loss(nn.Module):
     """L1 (mean absolute error, MAE) loss.
@@ -43,7 +215,7 @@ class L1Loss(nn.Module):
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
 
-        self.loss_weight = loss_weight
+        self.loss_weight = float(loss_weight)
         self.reduction = reduction
 
     def forward(self, pred, target, weight=None, **kwargs):
@@ -53,7 +225,12 @@ class L1Loss(nn.Module):
             target (Tensor): of shape (N, C, H, W). Ground truth tensor.
             weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
         """
-        return self.loss_weight * l1_loss(pred, target, weight, reduction=self.reduction)
+        if weight is None and self.reduction != 'none':
+            # no weighting needed, use the native reduction directly
+            loss = F.l1_loss(pred, target, reduction=self.reduction)
+        else:
+            loss = l1_loss(pred, target, weight, reduction=self.reduction)
+        return loss if self.loss_weight == 1.0 else self.loss_weight * loss
 
 
 @LOSS_REGISTRY.register()
@@ -71,7 +248,7 @@ class MSELoss(nn.Module):
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
 
-        self.loss_weight = loss_weight
+        self.loss_weight = float(loss_weight)
         self.reduction = reduction
 
     def forward(self, pred, target, weight=None, **kwargs):
@@ -81,7 +258,12 @@ class MSELoss(nn.Module):
             target (Tensor): of shape (N, C, H, W). Ground truth tensor.
             weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
         """
-        return self.loss_weight * mse_loss(pred, target, weight, reduction=self.reduction)
+        if weight is None and self.reduction != 'none':
+            # no weighting needed, use the native reduction directly
+            loss = F.mse_loss(pred, target, reduction=self.reduction)
+        else:
+            loss = mse_loss(pred, target, weight, reduction=self.reduction)
+        return loss if self.loss_weight == 1.0 else self.loss_weight * loss
 
 
 @LOSS_REGISTRY.register()
@@ -104,7 +286,7 @@ class CharbonnierLoss(nn.Module):
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
 
-        self.loss_weight = loss_weight
+        self.loss_weight = float(loss_weight)
         self.reduction = reduction
         self.eps = eps
 
@@ -115,36 +297,36 @@ class CharbonnierLoss(nn.Module):
             target (Tensor): of shape (N, C, H, W). Ground truth tensor.
             weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
         """
-        return self.loss_weight * charbonnier_loss(pred, target, weight, eps=self.eps, reduction=self.reduction)
+        loss = charbonnier_loss(pred, target, weight, eps=self.eps, reduction=self.reduction)
+        return loss if self.loss_weight == 1.0 else self.loss_weight * loss
 
 
 @LOSS_REGISTRY.register()
-class WeightedTVLoss(L1Loss):
+class WeightedTVLoss(nn.Module):
     """Weighted TV loss.
 
     Args:
         loss_weight (float): Loss weight. Default: 1.0.
+        reduction (str): Specifies the reduction to apply to the output.
+            Supported choices are 'mean' | 'sum'. Default: 'mean'.
     """
 
     def __init__(self, loss_weight=1.0, reduction='mean'):
+        super(WeightedTVLoss, self).__init__()
         if reduction not in ['mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: mean | sum')
-        super(WeightedTVLoss, self).__init__(loss_weight=loss_weight, reduction=reduction)
-
-    def forward(self, pred, weight=None):
-        if weight is None:
-            y_weight = None
-            x_weight = None
-        else:
-            y_weight = weight[:, :, :-1, :]
-            x_weight = weight[:, :, :, :-1]
 
-        y_diff = super().forward(pred[:, :, :-1, :], pred[:, :, 1:, :], weight=y_weight)
-        x_diff = super().forward(pred[:, :, :, :-1], pred[:, :, :, 1:], weight=x_weight)
-
-        loss = x_diff + y_diff
+        self.loss_weight = float(loss_weight)
+        self.reduction = reduction
 
-        return loss
+    def forward(self, pred, weight=None):
+        """
+        Args:
+            pred (Tensor): of shape (N, C, H, W). Predicted tensor.
+            weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
+        """
+        loss = weighted_tv_loss(pred, weight, reduction=self.reduction)
+        return loss if self.loss_weight == 1.0 else self.loss_weight * loss
 
 
 @LOSS_REGISTRY.register()
@@ -169,8 +351,21 @@ class PerceptualLoss(nn.Module):
             calculated and the loss will multiplied by the weight.
             Default: 0.
         criterion (str): Criterion used for perceptual loss. Default: 'l1'.
+        cache_gt (bool): If True, cache the vgg features of the ground-truth,
+            and reuse them when the very same (unmodified) gt tensor object is
+            passed in again. Entries are dropped once their gt is freed. Loops
+            that build a new gt tensor every step (e.g., `feed_data`) should
+            use `precompute_gt_features` instead. Default: False.
+        channels_last (bool): If True, run vgg in channels_last memory format.
+            Default: False.
+        amp_dtype (str): If set ('fp16' | 'bf16'), store the vgg weights in this
+            dtype and run vgg under autocast. The criterion is still computed
+            in fp32. Default: None.
     """
 
+    # max number of gt tensors whose features are kept when cache_gt is True
+    gt_cache_size = 16
+
     def __init__(self,
                  layer_weights,
                  vgg_type='vgg19',
@@ -178,50 +373,68 @@ class PerceptualLoss(nn.Module):
                  range_norm=False,
                  perceptual_weight=1.0,
                  style_weight=0.,
-                 criterion='l1'):
+                 criterion='l1',
+                 cache_gt=False,
+                 channels_last=False,
+                 amp_dtype=None):
         super(PerceptualLoss, self).__init__()
-        self.perceptual_weight = perceptual_weight
-        self.style_weight = style_weight
+        self.perceptual_weight = float(perceptual_weight)
+        self.style_weight = float(style_weight)
         self.layer_weights = layer_weights
+        self.cache_gt = cache_gt
+        self._gt_cache = OrderedDict()
         self.vgg = VGGFeatureExtractor(
             layer_name_list=list(layer_weights.keys()),
             vgg_type=vgg_type,
             use_input_norm=use_input_norm,
             range_norm=range_norm)
+        self.channels_last = channels_last
+        if channels_last:
+            self.vgg = self.vgg.to(memory_format=torch.channels_last)
+        self.amp_dtype = get_amp_dtype(amp_dtype)
+        if self.amp_dtype is not None:
+            # vgg is frozen, so keep its weights in the autocast dtype instead of
+            # casting them on every forward
+            self.vgg.vgg_net.to(self.amp_dtype)
 
         self.criterion_type = criterion
-        if self.criterion_type == 'l1':
-            self.criterion = torch.nn.L1Loss()
-        elif self.criterion_type == 'l2':
-            self.criterion = torch.nn.L2loss()
-        elif self.criterion_type == 'fro':
-            self.criterion = None
-        else:
+        if self.criterion_type not in ['l1', 'l2', 'fro']:
             raise NotImplementedError(f'{criterion} criterion has not been supported.')
 
-    def forward(self, x, gt):
+    def forward(self, x, gt, gt_features=None):
         """Forward function.
 
         Args:
             x (Tensor): Input tensor with shape (n, c, h, w).
             gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+            gt_features (dict[str, Tensor], optional): Vgg features of gt from
+                `precompute_gt_features`. If given, vgg is only run on x.
+                Default: None.
 
         Returns:
             Tensor: Forward results.
         """
         # extract vgg features
-        x_features = self.vgg(x)
-        gt_features = self.vgg(gt.detach())
+        if gt_features is not None:
+            x_features = self._extract_features(x)
+        elif self.cache_gt or (torch.is_grad_enabled() and x.requires_grad):
+            x_features = self._extract_features(x)
+            gt_features = self._gt_features(gt)
+        else:
+            # nothing to backpropagate (e.g., validation), so run x and gt
+            # through vgg as a single batch
+            features = self._extract_features(torch.cat([x, gt.detach()], dim=0))
+            x_features, gt_features = {}, {}
+            for k, v in features.items():
+                x_features[k], gt_features[k] = v.chunk(2, dim=0)
 
         # calculate perceptual loss
         if self.perceptual_weight > 0:
             percep_loss = 0
             for k in x_features.keys():
-                if self.criterion_type == 'fro':
-                    percep_loss += torch.norm(x_features[k] - gt_features[k], p='fro') * self.layer_weights[k]
-                else:
-                    percep_loss += self.criterion(x_features[k], gt_features[k]) * self.layer_weights[k]
-            percep_loss *= self.perceptual_weight
+                percep_loss += feature_loss(x_features[k], gt_features[k], self.criterion_type) * self.layer_weights[k]
+            if self.perceptual_weight != 1.0:
+                percep_loss *= self.perceptual_weight
         else:
             percep_loss = None
 
@@ -229,18 +442,76 @@ class PerceptualLoss(nn.Module):
         if self.style_weight > 0:
             style_loss = 0
             for k in x_features.keys():
-                if self.criterion_type == 'fro':
-                    style_loss += torch.norm(
-                        self._gram_mat(x_features[k]) - self._gram_mat(gt_features[k]), p='fro') * self.layer_weights[k]
-                else:
-                    style_loss += self.criterion(self._gram_mat(x_features[k]), self._gram_mat(
-                        gt_features[k])) * self.layer_weights[k]
-            style_loss *= self.style_weight
+                style_loss += feature_loss(
+                    self._gram_mat(x_features[k]), self._gram_mat(gt_features[k]),
+                    self.criterion_type) * self.layer_weights[k]
+            if self.style_weight != 1.0:
+                style_loss *= self.style_weight
         else:
             style_loss = None
 
         return percep_loss, style_loss
 
+    def _extract_features(self, x):
+        return extract_features(self.vgg, x, self.channels_last, self.amp_dtype)
+
+    def precompute_gt_features(self, gt):
+        """Extract vgg features of the ground-truth, to be reused by forward.
+
+        Useful when the same gt is compared against many outputs, e.g., in
+        validation: compute the features once and pass them to forward as
+        `gt_features`.
+
+        Args:
+            gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+
+        Returns:
+            dict[str, Tensor]: Vgg features of gt.
+        """
+        with torch.no_grad():
+            return self._extract_features(gt.detach())
+
+    def _gt_features(self, gt):
+        """Extract vgg features of the ground-truth.
+
+        No gradient flows into the gt branch, so it runs under `no_grad` to
+        skip storing activations for backward. When `cache_gt` is True, the
+        features are looked up by the gt storage, and reused only if it is the
+        very same tensor object and it has not been modified in-place since.
+        An entry is evicted as soon as its gt tensor is freed.
+
+        Args:
+            gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+
+        Returns:
+            dict[str, Tensor]: Vgg features of gt.
+        """
+        if not self.cache_gt:
+            return self.precompute_gt_features(gt)
+
+        key = (gt.data_ptr(), tuple(gt.shape), gt.dtype, gt.device)
+        cached = self._gt_cache.get(key)
+        if cached is not None:
+            gt_ref, version, gt_features = cached
+            if gt_ref() is gt and version == gt._version:
+                self._gt_cache.move_to_end(key)
+                return gt_features
+
+        gt_features = self.precompute_gt_features(gt)
+        gt_cache = self._gt_cache
+
+        def evict(gt_ref, key=key):
+            # do not keep the features of a freed gt around until LRU eviction
+            cached = gt_cache.get(key)
+            if cached is not None and cached[0] is gt_ref:
+                del gt_cache[key]
+
+        gt_cache[key] = (weakref.ref(gt, evict), gt._version, gt_features)
+        gt_cache.move_to_end(key)
+        if len(gt_cache) > self.gt_cache_size:
+            gt_cache.popitem(last=False)
+        return gt_features
+
     def _gram_mat(self, x):
         """Calculate Gram matrix.
 
@@ -251,9 +522,10 @@ class PerceptualLoss(nn.Module):
             torch.Tensor: Gram matrix.
         """
         n, c, h, w = x.size()
-        features = x.view(n, c, w * h)
-        features_t = features.transpose(1, 2)
-        gram = features.bmm(features_t) / (c * h * w)
+        features = x.reshape(n, c, w * h)
+        # fold the normalization into the gemm via alpha (beta=0 ignores the input)
+        gram = torch.baddbmm(
+            features.new_empty(n, c, c), features, features.transpose(1, 2), beta=0, alpha=1 / (c * h * w))
         return gram
 
 
@@ -267,27 +539,33 @@ class LPIPSBaseNet(nn.Module):
             'mean', torch.Tensor([-.030, -.088, -.188])[None, :, None, None])
         self.register_buffer(
             'std', torch.Tensor([.458, .448, .450])[None, :, None, None])
+        # z_score as a single multiply-add: x * (1 / std) - mean / std
+        self.register_buffer('scale', 1 / self.std, persistent=False)
+        self.register_buffer('shift', -self.mean / self.std, persistent=False)
 
     def set_requires_grad(self, state):
-        for param in itertools.chain(self.parameters(), self.buffers()):
+        for param in self.parameters():
             param.requires_grad = state
 
+    def train(self, mode=True):
+        # the network is frozen, so it always stays in eval mode
+        return super(LPIPSBaseNet, self).train(False)
+
     def z_score(self, x):
-        return (x - self.mean) / self.std
+        return torch.addcmul(self.shift, x, self.scale)
 
     def normalize_activation(self, x, eps=1e-10):
-        norm_factor = torch.sqrt(torch.sum(x ** 2, dim=1, keepdim=True))
-        return x / (norm_factor + eps)
+        return normalize_activation(x, eps)
 
     def forward(self, x):
         x = self.z_score(x)
         output = []
-        for i, (_, layer) in enumerate(self.layers._modules.items(), 1):
+        for i, layer in enumerate(self.layers, 1):
             x = layer(x)
             if i in self.target_layers:
                 output.append(self.normalize_activation(x))
-            if len(output) == len(self.target_layers):
-                break
+                if i == self.max_target_layer:
+                    break
         return output
 
 
@@ -296,10 +574,12 @@ class LPIPSAlexNet(LPIPSBaseNet):
         super(LPIPSAlexNet, self).__init__()
 
         self.layers = alexnet(True).features
-        self.target_layers = [2, 5, 8, 10, 12]
+        self.target_layers = frozenset([2, 5, 8, 10, 12])
+        self.max_target_layer = max(self.target_layers)
         self.n_channels_list = [64, 192, 384, 256, 256]
 
         self.set_requires_grad(False)
+        self.eval()
 
 
 class LPIPSVGG16(LPIPSBaseNet):
@@ -307,10 +587,12 @@ class LPIPSVGG16(LPIPSBaseNet):
         super(LPIPSVGG16, self).__init__()
 
         self.layers = vgg16(True).features
-        self.target_layers = [4, 9, 16, 23, 30]
+        self.target_layers = frozenset([4, 9, 16, 23, 30])
+        self.max_target_layer = max(self.target_layers)
         self.n_channels_list = [64, 128, 256, 512, 512]
 
         self.set_requires_grad(False)
+        self.eval()
 
 
 @LOSS_REGISTRY.register()
@@ -322,9 +604,17 @@ class LPIPSLoss(nn.Module):
         net_type (str): the network type to compare the features:
                         'alex' | 'squeeze' | 'vgg'. Default: 'alex'.
         alpha (List):
+        channels_last (bool): If True, run the network in channels_last memory
+            format. Default: False.
+        amp_dtype (str): If set ('fp16' | 'bf16'), store the network weights in
+            this dtype and run it under autocast. Default: None.
     """
 
-    def __init__(self, net_type='vgg', alpha=None, perceptual_weight=1.0,use_rangenorm=False):
+    # renamed pretrained state dicts of the linear layers, keyed by net_type
+    _state_dict_cache = {}
+
+    def __init__(self, net_type='vgg', alpha=None, perceptual_weight=1.0,use_rangenorm=False, channels_last=False,
+                 amp_dtype=None):
         super(LPIPSLoss, self).__init__()
 
         # pretrained network
@@ -333,13 +623,20 @@ class LPIPSLoss(nn.Module):
         else:
             self.alpha = alpha
         self.net = self.get_network(net_type)
+        self.channels_last = channels_last
+        if channels_last:
+            self.net = self.net.to(memory_format=torch.channels_last)
+        self.amp_dtype = get_amp_dtype(amp_dtype)
+        if self.amp_dtype is not None:
+            # the network is frozen, so keep its weights in the autocast dtype
+            self.net.layers.to(self.amp_dtype)
 
         self.use_rangenorm = use_rangenorm
         # linear layers
         self.lin = self.LPIPSLinLayers(self.net.n_channels_list)
         self.lin.load_state_dict(self.get_state_dict(net_type), strict=True)
 
-        self.perceptual_weight = perceptual_weight
+        self.perceptual_weight = float(perceptual_weight)
 
         # # the mean is for image with range [0, 1]
         # self.register_buffer('mean', torch.Tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
@@ -355,18 +652,26 @@ class LPIPSLoss(nn.Module):
         return modulelist
 
     def get_state_dict(self, net_type):
-        # build state dict
-        old_state_dict = torch.load("./experiments/pretrained_models/lpips_{}.pth".format(net_type), map_location='cpu')
-
-        # rename keys
-        new_state_dict = OrderedDict()
-        for key, val in old_state_dict.items():
-            new_key = key
-            new_key = new_key.replace('lin', '')
-            new_key = new_key.replace('model.', '')
-            new_state_dict[new_key] = val
-
-        return new_state_dict
+        # the renamed state dict is loaded once per net_type and shared, since
+        # load_state_dict copies it into the linear layers
+        if net_type not in self._state_dict_cache:
+            old_state_dict = torch.load(
+                "./experiments/pretrained_models/lpips_{}.pth".format(net_type), map_location='cpu', weights_only=True)
+            # rename keys
+            self._state_dict_cache[net_type] = OrderedDict(
+                (key.replace('lin', '').replace('model.', ''), val) for key, val in old_state_dict.items())
+
+        return self._state_dict_cache[net_type]
+
+    def _extract_features(self, x):
+        return extract_features(self.net, x, self.channels_last, self.amp_dtype)
+
+    def _lin_weight(self):
+        # all linear layers flattened into one vector, see lpips_distance. alpha and
+        # perceptual_weight are folded in (scalars on tiny vectors), so the loss
+        # needs no extra multiply. Built on every call, so that it follows lin,
+        # alpha and perceptual_weight
+        return torch.cat([self.perceptual_weight * a * l[1].weight.flatten() for a, l in zip(self.alpha, self.lin)])
 
     def get_network(self, net_type):
         if net_type == 'alex':
@@ -391,11 +696,15 @@ class LPIPSLoss(nn.Module):
             gt = (gt - 0.5) * 2
 
         if self.perceptual_weight>0:
-            feat_x, feat_y = self.net(x), self.net(gt.detach())
-            diff = [(fx - fy) ** 2 for fx, fy in zip(feat_x, feat_y)]
-            res = [l(d).mean((2, 3), True) * a for a, d, l in zip(self.alpha, diff, self.lin)]
-
-            return self.perceptual_weight * torch.sum(torch.cat(res, 0)),None
+            if torch.is_grad_enabled() and x.requires_grad:
+                feat_x = self._extract_features(x)
+                with torch.no_grad():
+                    feat_y = self._extract_features(gt.detach())
+            else:
+                # nothing to backpropagate, so run x and gt as a single batch
+                feats = self._extract_features(torch.cat([x, gt.detach()], dim=0))
+                feat_x, feat_y = zip(*[f.chunk(2, dim=0) for f in feats])
+            return lpips_distance(feat_x, feat_y, self._lin_weight()),None
         else:
             return None,None
 # LPIPS
@@ -403,8 +712,18 @@ class LPIPSLoss(nn.Module):
 # stereoBMLoss
 @LOSS_REGISTRY.register()
 class StereoBMLoss(nn.Module):
+    """L1 loss between the block matching disparities of predicted and
+    ground-truth stereo pairs.
+
+    Args:
+        numDisparities (int): Number of disparities searched. Default: 128.
+        blockSize (int): Size of the (odd) matching block. Default: 21.
+    """
+
     def __init__(self, numDisparities=128, blockSize=21):
-        super(StereoBM, self).__init__()
+        super(StereoBMLoss, self).__init__()
+        if blockSize % 2 == 0:
+            raise ValueError(f'blockSize must be odd, but got {blockSize}.')
         self.numDisparities = numDisparities
         self.blockSize = blockSize
 
@@ -421,9 +740,10 @@ class StereoBMLoss(nn.Module):
         # 图像预处理
         left_gt, right_gt = gt[:,:3,:,:],gt[:,3:,:,:]
         left_pred, right_pred = x[:,:3,:,:],x[:,3:,:,:]
-        # 计算视差
-        disparity_gt = self.calculate_disparity(left_gt, right_gt)
-        disparity_pred = self.calculate_disparity(left_pred, right_pred)
+        # 计算视差 (argmin has no gradient, so skip building the cost volume graph)
+        with torch.no_grad():
+            disparity_gt = self.calculate_disparity(left_gt, right_gt)
+            disparity_pred = self.calculate_disparity(left_pred, right_pred)
 
         # 计算loss
         loss = F.l1_loss(disparity_pred, disparity_gt, reduction='mean')
@@ -431,27 +751,44 @@ class StereoBMLoss(nn.Module):
         return loss
 
     def calculate_disparity(self, img_left, img_right):
-        img_left = F.normalize(img_left, p=2, dim=1)
-        img_right = F.normalize(img_right, p=2, dim=1)
-
-        # 创建输出视差图
-        disparity = torch.zeros(img_left.shape[0], 1, img_left.shape[2], img_left.shape[3], device=img_left.device)
-
-        # 设置搜索窗口大小
-        search_range = self.numDisparities * self.blockSize
-
-        # 获取左图的每个块
-        left_blocks = F.unfold(img_left, kernel_size=self.blockSize, stride=1, padding=self.blockSize//2)
+        """Block matching disparity of a rectified stereo pair.
 
-        # 在右图中搜索匹配块
-        for k in range(max(self.blockSize//2 - self.numDisparities, -img_left.shape[3] + self.blockSize//2), min(search_range - img_left.shape[3] - self.blockSize//2, img_right.shape[3] - self.blockSize//2 - img_left.shape[3] + self.blockSize//2)):
-            right_blocks = F.unfold(img_right[:, :, :, k:k+img_left.shape[3]], kernel_size=self.blockSize, stride=1, padding=self.blockSize//2)
-            match = F.l1_loss(left_blocks, right_blocks, reduction='mean')
-            match = match.reshape(img_left.shape[0], -1, img_left.shape[2], img_left.shape[3])
-            mask = torch.logical_and((k <= disparity) , (disparity < k + self.numDisparities)).float()
-            disparity = torch.where(mask.byte(), disparity, k + match.argmin(dim=1).unsqueeze(1))
-
-        # 后处理
-        disparity = disparity.squeeze(1)
+        Args:
+            img_left (Tensor): Left image with shape (n, c, h, w).
+            img_right (Tensor): Right image with shape (n, c, h, w).
 
-        return disparity
\ No newline at end of file
+        Returns:
+            Tensor: Disparity with shape (n, h, w).
+        """
+        img_left = F.normalize(img_left, p=2, dim=1)
+        img_right = F.normalize(img_right, p=2, dim=1)
+        w = img_left.shape[3]
+        num_disparities = min(self.numDisparities, w)
+
+        # build the cost volume from the windows of the padded right image. Both
+        # images are flipped horizontally first, so that window d is the right
+        # image shifted by disparity d (in flipped coordinates) and the volume
+        # needs no flip of its own
+        img_left = img_left.flip(3)
+        right_shifts = F.pad(img_right, (num_disparities - 1, 0)).flip(3).unfold(3, w, 1)  # (n, c, h, d, w)
+        # accumulate over channels, so at most two (n, d, h, w) volumes are alive
+        cost = (img_left[:, :1] - right_shifts[:, 0].transpose(1, 2)).abs_()
+        buffer = torch.empty_like(cost)
+        for i in range(1, img_left.shape[1]):
+            cost.add_(torch.sub(img_left[:, i:i + 1], right_shifts[:, i].transpose(1, 2), out=buffer).abs_())
+        cost.div_(img_left.shape[1])
+        del buffer
+
+        # 聚合: average the cost over each block with a separable box filter
+        pad = self.blockSize // 2
+        cost = F.avg_pool2d(cost, (1, self.blockSize), stride=1, padding=(0, pad))
+        cost = F.avg_pool2d(cost, (self.blockSize, 1), stride=1, padding=(pad, 0))
+
+        # pixels with x < d have no match in the right image (x is flipped here)
+        disparities = torch.arange(num_disparities, device=cost.device)
+        invalid = torch.arange(w - 1, -1, -1, device=cost.device)[None, :] < disparities[:, None]
+        cost = cost.masked_fill_(invalid[:, None, :], float('inf'))
+
+        disparity = cost.argmin(dim=1).flip(2).to(img_left.dtype)
+
+        return disparity
@@ -1,7 +1,10 @@
 import functools
+import os
 import torch
 from torch.nn import functional as F
 
+BASICSR_COMPILE = os.getenv('BASICSR_COMPILE')
+
 
 def reduce_loss(loss, reduction):
     """Reduce loss as specified.
@@ -96,6 +99,39 @@ def weighted_loss(loss_func):
     return wrapper
 
 
+def compile_loss(loss_func=None, **compile_kwargs):
+    """Fuse the element-wise ops of a loss function with ``torch.compile``.
+
+    Pixel losses are bandwidth-bound: run eagerly, every subtract / abs /
+    square / sqrt launches its own kernel and round-trips the whole tensor
+    through memory. Compiling them lets inductor generate a single fused
+    kernel instead.
+
+    Compilation is opt-in, in the same way as ``BASICSR_JIT`` for the custom
+    ops: it is only applied when ``BASICSR_COMPILE=True`` is set and
+    ``torch.compile`` is available (PyTorch >= 2.0). Otherwise the function is
+    returned unchanged.
+
+    Args:
+        loss_func (callable): The function to compile.
+        compile_kwargs (dict): Extra arguments for ``torch.compile``.
+            ``dynamic`` defaults to True, since the input shapes vary.
+
+    :Example:
+
+    >>> @compile_loss
+    >>> @weighted_loss
+    >>> def l1_loss(pred, target):
+    >>>     return (pred - target).abs()
+    """
+    if loss_func is None:
+        return functools.partial(compile_loss, **compile_kwargs)
+    if BASICSR_COMPILE != 'True' or not hasattr(torch, 'compile'):
+        return loss_func
+    compile_kwargs.setdefault('dynamic', True)
+    return torch.compile(loss_func, **compile_kwargs)
+
+
 def get_local_weights(residual, ksize):
     """Get local weights for generating the artifact map of LDL.
 
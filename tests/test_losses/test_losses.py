@@ -1,7 +1,20 @@
 import pytest
 import torch
+import torchvision
+from torch.nn import functional as F
 
-from basicsr.losses.basic_loss import CharbonnierLoss, L1Loss, MSELoss, WeightedTVLoss
+from basicsr.archs import vgg_arch
+from basicsr.losses import basic_loss, loss_util
+from basicsr.losses.basic_loss import (CharbonnierLoss, L1Loss, LPIPSLoss, MSELoss, PerceptualLoss, StereoBMLoss,
+                                       WeightedTVLoss, extract_features, feature_loss, normalize_activation)
+
+
+@pytest.fixture
+def random_vgg(monkeypatch):
+    """Build VGGFeatureExtractor on randomly initialized weights, without downloading."""
+    vgg19 = vgg_arch.vgg.vgg19
+    monkeypatch.setattr(vgg_arch, 'VGG_PRETRAIN_PATH', '')
+    monkeypatch.setattr(vgg_arch.vgg, 'vgg19', lambda **kwargs: vgg19())
 
 
 @pytest.mark.parametrize('loss_class', [L1Loss, MSELoss, CharbonnierLoss])
@@ -70,3 +83,178 @@ def test_weightedtvloss():
         WeightedTVLoss(loss_weight=1.0, reduction='unknown')
     with pytest.raises(ValueError):
         WeightedTVLoss(loss_weight=1.0, reduction='none')
+
+
+@pytest.fixture
+def random_lpips(monkeypatch):
+    """Build LPIPSLoss on randomly initialized backbones and linear layers, without downloading."""
+    monkeypatch.setattr(basic_loss, 'alexnet', lambda *args, **kwargs: torchvision.models.alexnet())
+    monkeypatch.setattr(basic_loss, 'vgg16', lambda *args, **kwargs: torchvision.models.vgg16())
+    monkeypatch.setattr(
+        LPIPSLoss, 'get_state_dict', lambda self, net_type:
+        {f'{i}.1.weight': torch.rand(1, nc, 1, 1) for i, nc in enumerate(self.net.n_channels_list)})
+
+
+@pytest.mark.parametrize('net_type', ['alex', 'vgg'])
+def test_lpipsloss(random_lpips, net_type):
+    """Test loss: LPIPSLoss matches the per-layer formulation"""
+
+    def lpips_reference(loss, x, gt):
+        feat_x, feat_y = loss.net(x), loss.net(gt)
+        res = [l((fx - fy)**2).mean((2, 3), True) * a for a, fx, fy, l in zip(loss.alpha, feat_x, feat_y, loss.lin)]
+        return loss.perceptual_weight * torch.sum(torch.cat(res, 0))
+
+    x = torch.rand((2, 3, 32, 32), dtype=torch.float32, requires_grad=True)
+    gt = torch.rand((2, 3, 32, 32), dtype=torch.float32)
+    loss = LPIPSLoss(net_type, alpha=[1., 2., 0.5, 1., 3.], perceptual_weight=2.)
+    out, _ = loss(x, gt)
+    out_grad, = torch.autograd.grad(out, x)
+    ref = lpips_reference(loss, x, gt)
+    ref_grad, = torch.autograd.grad(ref, x)
+    assert torch.allclose(out, ref, rtol=1e-5)
+    assert torch.allclose(out_grad, ref_grad, rtol=1e-4, atol=1e-8)
+
+    with torch.no_grad():
+        assert torch.allclose(loss(x, gt)[0], ref, rtol=1e-5)
+
+    # later changes to the linear layers and weights must be picked up
+    loss.lin.load_state_dict({k: torch.rand_like(v) for k, v in loss.lin.state_dict().items()})
+    loss.alpha = [1., 1., 1., 1., 1.]
+    loss.perceptual_weight = 0.5
+    assert torch.allclose(loss(x, gt)[0], lpips_reference(loss, x, gt), rtol=1e-5)
+
+
+def test_perceptualloss_l2(random_vgg):
+    """Test loss: PerceptualLoss with criterion='l2'"""
+
+    def gram(feat):
+        n, c, h, w = feat.size()
+        feat = feat.view(n, c, h * w)
+        return feat.bmm(feat.transpose(1, 2)) / (c * h * w)
+
+    x = torch.rand((1, 3, 16, 16), dtype=torch.float32)
+    gt = torch.rand((1, 3, 16, 16), dtype=torch.float32)
+    layer_weights = {'conv1_2': 1., 'relu2_1': 0.5}
+    loss = PerceptualLoss(layer_weights, perceptual_weight=2., style_weight=3., criterion='l2')
+    percep_loss, style_loss = loss(x, gt)
+
+    x_features, gt_features = loss.vgg(x), loss.vgg(gt)
+    ref_percep = sum(F.mse_loss(x_features[k], gt_features[k]) * w for k, w in layer_weights.items())
+    ref_style = sum(F.mse_loss(gram(x_features[k]), gram(gt_features[k])) * w for k, w in layer_weights.items())
+    assert torch.allclose(percep_loss, 2 * ref_percep)
+    assert torch.allclose(style_loss, 3 * ref_style)
+
+
+def test_perceptualloss_gt_features(random_vgg):
+    """Test loss: PerceptualLoss with precomputed and cached gt features"""
+
+    x = torch.rand((1, 3, 16, 16), dtype=torch.float32)
+    gt = torch.rand((1, 3, 16, 16), dtype=torch.float32)
+    loss = PerceptualLoss({'conv1_2': 1., 'relu2_1': 1.}, style_weight=1.)
+    percep_loss, style_loss = loss(x, gt)
+
+    gt_features = loss.precompute_gt_features(gt)
+    assert all(not v.requires_grad for v in gt_features.values())
+    out = loss(x, gt, gt_features=gt_features)
+    assert torch.allclose(out[0], percep_loss)
+    assert torch.allclose(out[1], style_loss)
+
+    # -------------------- test cache_gt -------------------- #
+    loss.cache_gt = True
+    out = loss(x, gt)
+    assert torch.allclose(out[0], percep_loss)
+    assert len(loss._gt_cache) == 1
+    # a freed gt must not keep its features in the cache
+    for _ in range(3):
+        loss(x, gt.clone())
+    assert len(loss._gt_cache) == 1
+    del gt
+    assert len(loss._gt_cache) == 0
+
+
+def test_stereobmloss():
+    """Test loss: StereoBMLoss"""
+
+    left = torch.rand((1, 3, 16, 32), dtype=torch.float32)
+    # left[x] = right[x - 4]
+    right = torch.roll(left, -4, dims=3)
+    loss = StereoBMLoss(numDisparities=8, blockSize=5)
+    disparity = loss.calculate_disparity(left, right)
+    assert disparity.shape == (1, 16, 32)
+    assert torch.all(disparity[:, 2:-2, 6:-6] == 4)
+
+    out = loss(torch.cat([left, right], dim=1), torch.cat([left, right], dim=1))
+    assert isinstance(out, torch.Tensor)
+    assert out.shape == torch.Size([])
+    assert out.item() == 0
+
+    # -------------------- test unsupported block size -------------------- #
+    with pytest.raises(ValueError):
+        StereoBMLoss(blockSize=4)
+
+
+def test_extract_features():
+    """Test extract_features: autocast dtypes"""
+
+    net = torch.nn.Conv2d(3, 4, 3, 1, 1)
+    x = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    out = extract_features(lambda v: [net(v)], x, channels_last=True, amp_dtype=torch.bfloat16)
+    assert out[0].dtype == torch.float32
+    assert out[0].shape == (1, 4, 4, 4)
+
+    # -------------------- test unsupported autocast dtype -------------------- #
+    with pytest.raises(ValueError):
+        extract_features(lambda v: [net(v)], x, amp_dtype=torch.float16)
+
+
+def test_normalize_activation():
+    """Test normalize_activation: fp16 inputs must not overflow or underflow"""
+    x = torch.full((1, 4, 2, 2), 300, dtype=torch.float16)
+    out = normalize_activation(x)
+    assert out.dtype == torch.float16
+    assert torch.allclose(out.float(), torch.full((1, 4, 2, 2), 0.5))
+
+    out = normalize_activation(torch.zeros((1, 4, 2, 2), dtype=torch.float16))
+    assert torch.all(out == 0)
+
+    x = torch.rand((1, 4, 2, 2), dtype=torch.float32)
+    assert torch.allclose(normalize_activation(x), x / x.norm(dim=1, keepdim=True), atol=1e-6)
+
+
+def test_compile_loss(monkeypatch):
+    """Test compile_loss: functions are left eager unless BASICSR_COMPILE=True"""
+
+    def loss_func(pred, target):
+        return (pred - target).abs()
+
+    monkeypatch.setattr(loss_util, 'BASICSR_COMPILE', None)
+    assert loss_util.compile_loss(loss_func) is loss_func
+    assert loss_util.compile_loss(fullgraph=True)(loss_func) is loss_func
+
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason='torch.compile is not available')
+def test_compile_loss_enabled(monkeypatch):
+    """Test compile_loss: compiled functions match eager with BASICSR_COMPILE=True"""
+
+    def loss_func(pred, target):
+        return (pred - target).abs()
+
+    monkeypatch.setattr(loss_util, 'BASICSR_COMPILE', 'True')
+    eager_loss = loss_util.weighted_loss(loss_func)
+    compiled_loss = loss_util.compile_loss(eager_loss)
+    assert compiled_loss is not eager_loss
+
+    pred = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    target = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    weight = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    for reduction in ['none', 'mean', 'sum']:
+        assert torch.allclose(
+            compiled_loss(pred, target, reduction=reduction), eager_loss(pred, target, reduction=reduction))
+        assert torch.allclose(
+            compiled_loss(pred, target, weight, reduction=reduction),
+            eager_loss(pred, target, weight, reduction=reduction))
+
+    # string arguments are specialized on, as for the perceptual criteria
+    compiled_feature_loss = loss_util.compile_loss(feature_loss)
+    for criterion in ['l1', 'l2', 'fro']:
+        assert torch.allclose(compiled_feature_loss(pred, target, criterion), feature_loss(pred, target, criterion))